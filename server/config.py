@@ -2,6 +2,8 @@ import os
 
 AUTH_TOKEN = os.getenv("AUTH_TOKEN", "default-secret-token")
 DB_PATH = os.getenv("DB_PATH", "data/llmequeue.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))  # read-only connections for SELECTs
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "360"))  # processing tasks not finished within this go back to pending
 
 class Config:
     def __init__(self):
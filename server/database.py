@@ -1,135 +1,547 @@
+import asyncio
 import aiosqlite
+import os
+import queue
+import sys
+import threading
+import time
 import uuid
-import json
-from datetime import datetime
+import orjson
+from array import array
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional, Any
 
-from config import DB_PATH
+from config import DB_PATH, DB_READ_POOL_SIZE
+
+# Tasks live in two tables: tasks_pending holds only pending/processing tasks
+# (a handful of rows, so claiming stays a tiny index seek) and tasks_archive
+# holds completed/failed ones until they are fetched or cleaned up. Finishing
+# a task moves its row from one to the other in a single transaction.
+#
+# Hot-path statements, kept as constants so every call passes the identical
+# string and hits the connection's prepared-statement cache.
+_SQL_INSERT_TASK = "INSERT INTO tasks_pending (id, task_type, payload) VALUES (?, ?, ?)"
+_SQL_GET_TASK = """SELECT id, task_type, status, NULL AS result, NULL AS error, created_at, updated_at
+   FROM tasks_pending WHERE id = ?
+   UNION ALL
+   SELECT id, task_type, status, result, error, created_at, updated_at
+   FROM tasks_archive WHERE id = ?"""
+_SQL_GET_TASK_STATUS_AND_RESULT = """SELECT task_type, status, NULL AS result, NULL AS error
+   FROM tasks_pending WHERE id = ?
+   UNION ALL
+   SELECT task_type, status, result, error
+   FROM tasks_archive WHERE id = ?"""
+_SQL_CLAIM_NEXT_TASK = """UPDATE tasks_pending
+   SET status = 'processing', updated_at = ?
+   WHERE id = (SELECT id FROM tasks_pending WHERE status = 'pending' ORDER BY created_at, rowid LIMIT 1)
+     AND status = 'pending'
+   RETURNING id, task_type, payload"""
+_SQL_CLAIM_PENDING_EMBEDDINGS = """UPDATE tasks_pending
+   SET status = 'processing', updated_at = ?
+   WHERE id IN (SELECT id FROM tasks_pending
+                WHERE status = 'pending' AND task_type = 'embedding'
+                ORDER BY created_at, rowid LIMIT ?)
+   RETURNING id, task_type, payload"""
+_SQL_REQUEUE_STALE_TASKS = """UPDATE tasks_pending
+   SET status = 'pending', updated_at = ?
+   WHERE status = 'processing' AND updated_at < ?"""
+_SQL_RELEASE_TASK = "UPDATE tasks_pending SET status = 'pending' WHERE id = ? AND status = 'processing'"
+_SQL_GET_PROCESSING_TASK_TYPE = "SELECT task_type FROM tasks_pending WHERE id = ? AND status = 'processing'"
+_SQL_ARCHIVE_TASK = """INSERT INTO tasks_archive (id, task_type, status, result, error, created_at, updated_at)
+   SELECT id, task_type, ?, ?, ?, created_at, ?
+   FROM tasks_pending WHERE id = ? AND status = 'processing'"""
+_SQL_DELETE_PENDING_TASK = "DELETE FROM tasks_pending WHERE id = ?"
+_SQL_DELETE_ARCHIVED_TASK = "DELETE FROM tasks_archive WHERE id = ?"
+_SQL_CLEANUP_OLD_PENDING_TASKS = "DELETE FROM tasks_pending WHERE created_at < ?"
+_SQL_CLEANUP_OLD_ARCHIVED_TASKS = "DELETE FROM tasks_archive WHERE created_at < ?"
+
+# Room for every statement above plus the pragmas/DDL, so none is ever evicted
+_CACHED_STATEMENTS = 256
+
+# Long-lived connection shared by all requests (opened in init_db). Reusing it
+# avoids spawning a new aiosqlite thread and reopening the file per query.
+_db: Optional[aiosqlite.Connection] = None
+
+# The shared connection runs in autocommit mode (isolation_level=None):
+# single-statement writes commit on their own, and multi-statement writes
+# open an explicit BEGIN IMMEDIATE. This lock serializes those transactions
+# so one request never commits another's half-finished work.
+_write_lock = asyncio.Lock()
+
+# Read-only connections for SELECTs, opened lazily up to DB_READ_POOL_SIZE.
+# Each runs on its own aiosqlite thread, so reads don't queue behind writes
+# on the shared connection, and each keeps its page cache warm.
+_read_pool: Optional[asyncio.LifoQueue] = None
+_read_conns: list[aiosqlite.Connection] = []
+
+
+class _Waiter:
+    """In-process completion signal for a task, carrying its outcome."""
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.status: Optional[str] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+
+
+# Waiters keyed by task id. create_task registers one; complete_task/fail_task
+# fill in the outcome and set it, so waiting endpoints wake up immediately
+# without reading the task back from the database.
+_task_waiters: dict[str, _Waiter] = {}
+
+# Set (and replaced by a fresh one) whenever a batch of new tasks is inserted,
+# so long-polling workers wake up as soon as work arrives. Callers grab the
+# current event *before* trying to claim, so a wakeup can't be missed.
+_new_tasks_event = asyncio.Event()
+
+# New tasks are queued and inserted in batches, one transaction (and fsync)
+# per batch instead of per task. The batcher waits this long after the first
+# queued insert so concurrent create_task calls can join the same batch.
+INSERT_BATCH_WINDOW = 0.005
+_insert_queue: Optional[asyncio.Queue] = None
+_insert_batcher_task: Optional[asyncio.Task] = None
+
+# Task ids pre-generated by a background thread from one urandom read per
+# batch, so create_task doesn't pay an os.urandom syscall per request.
+_UUID_BATCH = 4096
+_uuid_pool: queue.Queue = queue.Queue(maxsize=_UUID_BATCH)
+_uuid_filler: Optional[threading.Thread] = None
+
+
+async def _configure(conn: aiosqlite.Connection):
+    """Apply per-connection pragmas.
+
+    WAL lets readers (client polling) proceed while a writer (worker claiming
+    or completing a task) holds the lock, and synchronous=NORMAL only fsyncs
+    at checkpoints instead of on every commit.
+    """
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA cache_size=-64000")
+    await conn.execute("PRAGMA busy_timeout=5000")
+    await conn.execute("PRAGMA wal_autocheckpoint=1000")
+
+
+def _encode_result(task_type: str, result_data: Any) -> bytes:
+    """Encode a task result for storage.
+
+    Embedding results (flat lists of numbers) are packed as little-endian
+    float32, roughly 5x smaller than their JSON text; bytes are an embedding
+    the worker already packed that way and are kept as is. Every other task
+    type is stored as JSON. Raises ValueError for a result that doesn't fit
+    its task type.
+    """
+    if task_type == "embedding":
+        if isinstance(result_data, bytes):
+            return result_data
+        try:
+            packed = array("f", result_data)
+        except TypeError:
+            raise ValueError("Embedding result must be a list of numbers") from None
+        if sys.byteorder == "big":
+            packed.byteswap()
+        return packed.tobytes()
+    if isinstance(result_data, bytes):
+        raise ValueError("Packed results are only valid for embedding tasks")
+    return orjson.dumps(result_data)
+
+
+def _decode_result(task_type: str, blob: Optional[bytes]) -> Any:
+    """Decode a stored task result (see _encode_result)."""
+    if blob is None:
+        return None
+    if task_type == "embedding":
+        unpacked = array("f")
+        unpacked.frombytes(blob)
+        if sys.byteorder == "big":
+            unpacked.byteswap()
+        return unpacked.tolist()
+    return orjson.loads(blob)
+
+
+@asynccontextmanager
+async def _reader():
+    """Borrow a read-only connection from the pool."""
+    if _read_pool.empty() and len(_read_conns) < DB_READ_POOL_SIZE:
+        # Register before awaiting so concurrent callers can't overshoot the pool size
+        conn = aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True, cached_statements=_CACHED_STATEMENTS)
+        _read_conns.append(conn)
+        # On failure, free the slot again, or every failed open would shrink
+        # the pool for good until reads block forever on _read_pool.get()
+        try:
+            await conn
+        except BaseException:
+            _read_conns.remove(conn)
+            raise
+        try:
+            conn.row_factory = aiosqlite.Row
+            await _configure(conn)
+        except BaseException:
+            _read_conns.remove(conn)
+            await conn.close()
+            raise
+    else:
+        conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+def _fill_uuid_pool():
+    """Keep the uuid pool topped up (runs in a daemon thread)."""
+    while True:
+        random_bytes = os.urandom(16 * _UUID_BATCH)
+        for offset in range(0, len(random_bytes), 16):
+            # version=4 sets the version and variant bits, exactly like uuid4()
+            _uuid_pool.put(str(uuid.UUID(bytes=random_bytes[offset:offset + 16], version=4)))
+
+
+def _new_task_id() -> str:
+    try:
+        return _uuid_pool.get_nowait()
+    except queue.Empty:
+        return str(uuid.uuid4())
+
+
+async def _insert_batcher():
+    """Drain queued inserts and write each batch with a single commit.
+
+    When the batcher stops (cancelled at shutdown, or crashed), every insert
+    still waiting on it is failed so no create_task call hangs.
+    """
+    batch = []
+    try:
+        while True:
+            batch = [await _insert_queue.get()]
+            await asyncio.sleep(INSERT_BATCH_WINDOW)
+            while not _insert_queue.empty():
+                batch.append(_insert_queue.get_nowait())
+
+            error = None
+            async with _write_lock:
+                try:
+                    await _db.execute("BEGIN IMMEDIATE")
+                    await _db.executemany(_SQL_INSERT_TASK, [row for row, _ in batch])
+                    await _db.commit()
+                except Exception as e:
+                    await _db.rollback()
+                    error = e
+                except BaseException:
+                    await _db.rollback()
+                    raise
+
+            if error is None:
+                _signal_new_tasks()
+
+            for _, future in batch:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+            batch = []
+    finally:
+        while not _insert_queue.empty():
+            batch.append(_insert_queue.get_nowait())
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Task insert batcher stopped"))
+
 
 async def init_db():
-    """Initialize the database and create tables if they don't exist."""
+    """Initialize the database, create tables if they don't exist and open the shared connection."""
+    global _db, _read_pool, _insert_queue, _insert_batcher_task, _uuid_filler
     Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id TEXT PRIMARY KEY,
-                task_type TEXT DEFAULT 'embedding',
-                payload TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                result TEXT,
-                error TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at)")
-        await db.commit()
+    _db = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=_CACHED_STATEMENTS)
+    _db.row_factory = aiosqlite.Row
+    # journal_mode is persistent, so setting it once here is enough
+    await _db.execute("PRAGMA journal_mode=WAL")
+    await _configure(_db)
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS tasks_pending (
+            id TEXT PRIMARY KEY,
+            task_type TEXT DEFAULT 'embedding',
+            payload BLOB NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at INTEGER DEFAULT (strftime('%s', 'now')),
+            updated_at INTEGER DEFAULT (strftime('%s', 'now'))
+        )
+    """)
+    await _db.execute("""
+        CREATE TABLE IF NOT EXISTS tasks_archive (
+            id TEXT PRIMARY KEY,
+            task_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result BLOB,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    # "Oldest pending task" becomes a single index seek with no sort: index
+    # entries are ordered by (status, created_at, rowid), which is exactly
+    # the claim's ORDER BY created_at, rowid
+    await _db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tasks_pending_status_created ON tasks_pending(status, created_at)"
+    )
+    await _db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_created_at ON tasks_archive(created_at)")
+    _read_pool = asyncio.LifoQueue()
+    _insert_queue = asyncio.Queue()
+    _insert_batcher_task = asyncio.create_task(_insert_batcher())
+    if _uuid_filler is None:
+        _uuid_filler = threading.Thread(target=_fill_uuid_pool, name="uuid-pool", daemon=True)
+        _uuid_filler.start()
+
+
+async def close_db():
+    """Stop the insert batcher and close the shared connection and the read pool."""
+    global _db, _insert_batcher_task
+    if _insert_batcher_task is not None:
+        _insert_batcher_task.cancel()
+        try:
+            await _insert_batcher_task
+        except asyncio.CancelledError:
+            pass
+        _insert_batcher_task = None
+    for conn in _read_conns:
+        await conn.close()
+    _read_conns.clear()
+    if _db is not None:
+        await _db.close()
+        _db = None
 
 
 async def cleanup_old_tasks() -> int:
     """Delete tasks older than 1 hour. Returns number of deleted tasks."""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "DELETE FROM tasks WHERE created_at < datetime('now', '-1 hour')"
-        )
-        await conn.commit()
-        return cursor.rowcount
+    cutoff = int(time.time()) - 3600
+    async with _write_lock:
+        try:
+            await _db.execute("BEGIN IMMEDIATE")
+            pending = await _db.execute(_SQL_CLEANUP_OLD_PENDING_TASKS, (cutoff,))
+            archived = await _db.execute(_SQL_CLEANUP_OLD_ARCHIVED_TASKS, (cutoff,))
+            await _db.commit()
+        except BaseException:
+            # Also on cancellation, so no transaction is left open on the shared connection
+            await _db.rollback()
+            raise
+        return pending.rowcount + archived.rowcount
+
+
+async def requeue_stale_tasks(lease_seconds: int) -> int:
+    """Put processing tasks claimed more than lease_seconds ago back to pending.
+
+    Covers claims whose worker never finished them: it crashed or restarted,
+    or dropped the long-polled claim just as the task was handed to it.
+    Requeued tasks keep their created_at, so they are claimed next. Returns
+    the number of requeued tasks.
+    """
+    now = int(time.time())
+    async with _write_lock:
+        cursor = await _db.execute(_SQL_REQUEUE_STALE_TASKS, (now, now - lease_seconds))
+        requeued = cursor.rowcount
+    if requeued:
+        _signal_new_tasks()
+    return requeued
+
 
 async def create_task(task_type: str, payload: dict) -> str:
     """Create a new task and return its ID."""
-    task_id = str(uuid.uuid4())
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
-            "INSERT INTO tasks (id, task_type, payload) VALUES (?, ?, ?)",
-            (task_id, task_type, json.dumps(payload))
-        )
-        await conn.commit()
+    if _insert_batcher_task is None or _insert_batcher_task.done():
+        raise RuntimeError("Task insert batcher is not running")
+    task_id = _new_task_id()
+    _task_waiters[task_id] = _Waiter()
+    inserted = asyncio.get_running_loop().create_future()
+    try:
+        await _insert_queue.put(((task_id, task_type, orjson.dumps(payload)), inserted))
+        await inserted
+    except BaseException:
+        # Includes cancellation (client disconnected), which would otherwise leak the waiter
+        _task_waiters.pop(task_id, None)
+        raise
     return task_id
 
+
+def get_task_waiter(task_id: str) -> Optional[_Waiter]:
+    """Get the waiter registered for a task created by this process."""
+    return _task_waiters.get(task_id)
+
+
+def discard_task_waiter(task_id: str):
+    """Forget a task's waiter (e.g. after the request gave up waiting)."""
+    _task_waiters.pop(task_id, None)
+
+
+def new_tasks_event() -> asyncio.Event:
+    """Get the event that is set when the next batch of tasks is inserted."""
+    return _new_tasks_event
+
+
+def _signal_new_tasks():
+    global _new_tasks_event
+    _new_tasks_event.set()
+    _new_tasks_event = asyncio.Event()
+
+
+def _signal_task(task_id: str, status: str, result: Any = None, error: Optional[str] = None):
+    waiter = _task_waiters.pop(task_id, None)
+    if waiter:
+        waiter.status = status
+        waiter.result = result
+        waiter.error = error
+        waiter.event.set()
+
+
 async def get_task(task_id: str) -> Optional[dict]:
-    """Get a task by ID."""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        conn.row_factory = aiosqlite.Row
-        cursor = await conn.execute(
-            "SELECT * FROM tasks WHERE id = ?",
-            (task_id,)
-        )
+    """Get a task by ID, with its result decoded."""
+    async with _reader() as conn:
+        cursor = await conn.execute(_SQL_GET_TASK, (task_id, task_id))
+        row = await cursor.fetchone()
+    if row:
+        task = dict(row)
+        task["result"] = _decode_result(task["task_type"], task["result"])
+        return task
+    return None
+
+
+async def get_task_status_and_result(task_id: str) -> Optional[dict]:
+    """Get just a task's status, decoded result and error (no timestamps)."""
+    async with _reader() as conn:
+        cursor = await conn.execute(_SQL_GET_TASK_STATUS_AND_RESULT, (task_id, task_id))
         row = await cursor.fetchone()
-        if row:
-            return dict(row)
+    if row:
+        return {
+            "status": row["status"],
+            "result": _decode_result(row["task_type"], row["result"]),
+            "error": row["error"],
+        }
     return None
 
 
 async def claim_next_task() -> Optional[dict]:
     """Atomically claim the next pending task for processing.
 
-    Uses conditional UPDATE to prevent race conditions - if another worker
-    claims the task between SELECT and UPDATE, rowcount will be 0.
+    A single UPDATE ... RETURNING selects and claims the oldest pending task,
+    so there is no window in which another worker can claim it in between.
     """
-    async with aiosqlite.connect(DB_PATH) as conn:
-        # Find a pending task
-        cursor = await conn.execute(
-            "SELECT id, task_type, payload FROM tasks WHERE status = 'pending' ORDER BY created_at LIMIT 1"
-        )
-        row = await cursor.fetchone()
+    async with _write_lock:
+        cursor = await _db.execute(_SQL_CLAIM_NEXT_TASK, (int(time.time()),))
+        # Exhaust the cursor so the autocommitted statement finishes right away
+        rows = await cursor.fetchall()
 
-        if not row:
-            return None
+    if not rows:
+        return None
+    return _claimed_task(rows[0])
 
-        # Atomically claim ONLY if still pending (prevents race condition)
-        cursor = await conn.execute(
-            "UPDATE tasks SET status = 'processing', updated_at = ? WHERE id = ? AND status = 'pending'",
-            (datetime.utcnow().isoformat(), row[0])
-        )
-        await conn.commit()
 
-        # If rowcount is 0, another worker claimed it first
-        if cursor.rowcount == 0:
-            return None
+async def claim_next_tasks(max_tasks: int) -> list[dict]:
+    """Atomically claim the next pending task, batched with more embeddings.
+
+    If the oldest pending task is an embedding, up to max_tasks - 1 further
+    pending embeddings are claimed in the same transaction, so a worker can
+    send them to the model in one request. Any other task is claimed alone.
+    """
+    now = int(time.time())
+    async with _write_lock:
+        try:
+            await _db.execute("BEGIN IMMEDIATE")
+            cursor = await _db.execute(_SQL_CLAIM_NEXT_TASK, (now,))
+            rows = await cursor.fetchall()
+            if rows and rows[0][1] == "embedding" and max_tasks > 1:
+                cursor = await _db.execute(_SQL_CLAIM_PENDING_EMBEDDINGS, (now, max_tasks - 1))
+                rows += await cursor.fetchall()
+            await _db.commit()
+        except BaseException:
+            await _db.rollback()
+            raise
+    return [_claimed_task(row) for row in rows]
+
+
+async def release_tasks(task_ids: list[str]):
+    """Put claimed tasks straight back to pending (their worker went away)."""
+    async with _write_lock:
+        try:
+            await _db.execute("BEGIN IMMEDIATE")
+            await _db.executemany(_SQL_RELEASE_TASK, [(task_id,) for task_id in task_ids])
+            await _db.commit()
+        except BaseException:
+            await _db.rollback()
+            raise
+    _signal_new_tasks()
 
-        return {
-            "id": row[0],
-            "task_type": row[1],
-            "payload": json.loads(row[2]),
-            "status": "processing"
-        }
+
+def _claimed_task(row) -> dict:
+    return {
+        "id": row[0],
+        "task_type": row[1],
+        "payload": orjson.loads(row[2]),
+        "status": "processing"
+    }
+
+
+async def _archive_task(task_id: str, status: str, result_data: Any, error: Optional[str]) -> bool:
+    """Move a processing task to the archive with its outcome.
+
+    The result is encoded according to the task's type, read in the same
+    transaction (see _encode_result).
+    """
+    async with _write_lock:
+        try:
+            await _db.execute("BEGIN IMMEDIATE")
+            cursor = await _db.execute(_SQL_GET_PROCESSING_TASK_TYPE, (task_id,))
+            row = await cursor.fetchone()
+            if row is not None:
+                result = None if result_data is None else _encode_result(row[0], result_data)
+                await _db.execute(
+                    _SQL_ARCHIVE_TASK,
+                    (status, result, error, int(time.time()), task_id)
+                )
+                await _db.execute(_SQL_DELETE_PENDING_TASK, (task_id,))
+            await _db.commit()
+        except BaseException:
+            await _db.rollback()
+            raise
+    return row is not None
 
 
 async def complete_task(task_id: str, result_data: Any) -> bool:
-    """Mark a task as completed with its result."""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            """UPDATE tasks
-               SET status = 'completed', result = ?, updated_at = ?
-               WHERE id = ? AND status = 'processing'""",
-            (json.dumps(result_data), datetime.utcnow().isoformat(), task_id)
-        )
-        await conn.commit()
-        return cursor.rowcount > 0
+    """Mark a task as completed with its result.
+
+    result_data may also be an embedding already packed as little-endian
+    float32 bytes; waiters still get it as a list of floats. Raises
+    ValueError if the result doesn't fit the task's type.
+    """
+    if await _archive_task(task_id, "completed", result_data, None):
+        # Only unpack for a waiter in this process; with several server
+        # processes most completions have none
+        if isinstance(result_data, bytes) and task_id in _task_waiters:
+            result_data = _decode_result("embedding", result_data)
+        _signal_task(task_id, "completed", result=result_data)
+        return True
+    return False
 
 
 async def fail_task(task_id: str, error: str) -> bool:
     """Mark a task as failed with an error message."""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            """UPDATE tasks
-               SET status = 'failed', error = ?, updated_at = ?
-               WHERE id = ? AND status = 'processing'""",
-            (error, datetime.utcnow().isoformat(), task_id)
-        )
-        await conn.commit()
-        return cursor.rowcount > 0
+    if await _archive_task(task_id, "failed", None, error):
+        _signal_task(task_id, "failed", error=error)
+        return True
+    return False
 
 
 async def delete_task(task_id: str) -> bool:
     """Delete a task from the database."""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "DELETE FROM tasks WHERE id = ?",
-            (task_id,)
-        )
-        await conn.commit()
-        return cursor.rowcount > 0
+    async with _write_lock:
+        try:
+            await _db.execute("BEGIN IMMEDIATE")
+            archived = await _db.execute(_SQL_DELETE_ARCHIVED_TASK, (task_id,))
+            pending = await _db.execute(_SQL_DELETE_PENDING_TASK, (task_id,))
+            await _db.commit()
+        except BaseException:
+            await _db.rollback()
+            raise
+        return archived.rowcount + pending.rowcount > 0
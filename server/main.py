@@ -1,12 +1,17 @@
-import json
+import base64
+import binascii
+import hmac
 import time
 import asyncio
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter, ValidationError
 from contextlib import asynccontextmanager
-from typing import Union
+from typing import Optional, Union
 
 import database
-from config import AUTH_TOKEN
+from config import AUTH_TOKEN, TASK_LEASE_SECONDS
 from models import (
     WorkerFailRequest,
     EmbeddingData,
@@ -21,6 +26,27 @@ from models import (
 
 
 cleanup_task = None
+requeue_task = None
+
+# How often a waiting request re-reads its task from the database: starting
+# at the min and doubling up to the max. Results reported to this process wake
+# the waiter immediately; the re-reads pick up results another server process
+# (uvicorn --workers) received, which is most of them, so the cap bounds the
+# added latency there.
+TASK_RECHECK_MIN_INTERVAL = 0.01
+TASK_RECHECK_MAX_INTERVAL = 0.1
+
+# How often a long-polling /worker/next re-checks the queue. Tasks created by
+# this process wake it immediately; this covers tasks created by another
+# server process.
+WORKER_RECHECK_INTERVAL = 1.0
+
+# Upper bound for the `max` parameter of /worker/next_batch
+MAX_CLAIM_BATCH_SIZE = 256
+
+# How often processing tasks past their TASK_LEASE_SECONDS lease are put back
+# to pending
+REQUEUE_INTERVAL = 30
 
 
 async def periodic_cleanup():
@@ -36,105 +62,249 @@ async def periodic_cleanup():
             print(f"Cleanup error: {e}")
 
 
+async def periodic_requeue():
+    """Background task to periodically requeue tasks whose worker went away."""
+    while True:
+        try:
+            await asyncio.sleep(REQUEUE_INTERVAL)
+            requeued = await database.requeue_stale_tasks(TASK_LEASE_SECONDS)
+            if requeued:
+                print(f"Requeued {requeued} stale processing task(s)")
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"Requeue error: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage app startup and shutdown."""
-    global cleanup_task
+    global cleanup_task, requeue_task
     await database.init_db()
     cleanup_task = asyncio.create_task(periodic_cleanup())
+    requeue_task = asyncio.create_task(periodic_requeue())
     yield
-    if cleanup_task:
-        cleanup_task.cancel()
-        try:
-            await cleanup_task
-        except asyncio.CancelledError:
-            pass
+    for task in (cleanup_task, requeue_task):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    await database.close_db()
 
 
-app = FastAPI(title="LLMeQueue API", lifespan=lifespan)
+app = FastAPI(title="LLMeQueue API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+# Full expected header value, so each request is a single constant-time compare
+_EXPECTED_AUTHORIZATION = f"Bearer {AUTH_TOKEN}".encode()
 
 
 def verify_token(authorization: str = Header(...)) -> str:
     """Verify the Bearer token."""
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid authorization header")
-    token = authorization[7:]
-    if token != AUTH_TOKEN:
+    if not hmac.compare_digest(authorization.encode(), _EXPECTED_AUTHORIZATION):
         raise HTTPException(status_code=401, detail="Invalid token")
-    return token
+    return AUTH_TOKEN
+
+
+# Every route except /health requires the Bearer token
+auth_router = APIRouter(dependencies=[Depends(verify_token)])
+
+# Built once and fed the raw body, so the OpenAI endpoints validate straight
+# from JSON bytes on pydantic-core's fast path
+_EMBEDDING_REQUEST_ADAPTER = TypeAdapter(OpenAIEmbeddingRequest)
+_CHAT_REQUEST_ADAPTER = TypeAdapter(ChatCompletionRequest)
+
+
+def json_body_openapi(adapter: TypeAdapter) -> dict:
+    """openapi_extra documenting the JSON body a raw-Request route parses.
+
+    Nested models point at components/schemas, where the response models
+    already register them (ChatMessage), instead of at local $defs.
+    """
+    schema = adapter.json_schema(ref_template="#/components/schemas/{model}")
+    schema.pop("$defs", None)
+    return {"requestBody": {"content": {"application/json": {"schema": schema}}, "required": True}}
+
+
+async def parse_body(adapter: TypeAdapter, http_request: Request):
+    """Validate a JSON request body, reporting errors like FastAPI's own body parsing."""
+    try:
+        return adapter.validate_json(await http_request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors()]
+        )
+
+
+async def wait_for_task(task_id: str, max_wait: float) -> Optional[dict]:
+    """Wait until a task is completed or failed. Returns None on timeout.
+
+    The returned dict has the task's status, result and error. When the result
+    was reported to this process it comes straight from the waiter, with no
+    database read.
+    """
+    waiter = database.get_task_waiter(task_id)
+    event = waiter.event if waiter else asyncio.Event()
+    deadline = time.monotonic() + max_wait
+    delay = TASK_RECHECK_MIN_INTERVAL
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, delay))
+                return {"status": waiter.status, "result": waiter.result, "error": waiter.error}
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, TASK_RECHECK_MAX_INTERVAL)
+            task = await database.get_task_status_and_result(task_id)
+            if task is None:
+                # Deleted or cleaned up while we were waiting
+                raise HTTPException(status_code=404, detail="Task not found")
+            if task["status"] in ("completed", "failed"):
+                return task
+    finally:
+        database.discard_task_waiter(task_id)
 
 
 # Client endpoints
 
-@app.get("/tasks/{task_id}")
-async def get_task(task_id: str, token: str = Depends(verify_token)):
+@auth_router.get("/tasks/{task_id}")
+async def get_task(task_id: str):
     """Get task status and result."""
     task = await database.get_task(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    result = None
-    if task["result"]:
-        result = json.loads(task["result"])
-
     return {
         "id": task["id"],
         "task_type": task["task_type"],
         "status": task["status"],
-        "result": result,
+        "result": task["result"],
         "error": task["error"],
         "created_at": task["created_at"],
         "updated_at": task["updated_at"],
     }
 
 
-@app.get("/tasks/{task_id}/result")
-async def get_task_result(task_id: str, token: str = Depends(verify_token)):
+@auth_router.get("/tasks/{task_id}/result")
+async def get_task_result(task_id: str):
     """Get only the result."""
-    task = await database.get_task(task_id)
+    task = await database.get_task_status_and_result(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     if task["status"] != "completed":
         raise HTTPException(status_code=400, detail=f"Task is not completed (status: {task['status']})")
-    if not task["result"]:
+    if task["result"] is None:
         raise HTTPException(status_code=500, detail="Task completed but no result found")
 
-    return {"id": task["id"], "result": json.loads(task["result"])}
+    return {"id": task_id, "result": task["result"]}
 
 
 # Worker endpoints
 
-@app.post("/worker/next")
-async def worker_claim_next(token: str = Depends(verify_token)):
-    """Claim the next pending task for processing."""
-    task = await database.claim_next_task()
-    if not task:
-        return {"task": None}
-    return {"task": {"id": task["id"], "task_type": task["task_type"], "payload": task["payload"]}}
+async def long_poll_claim(http_request: Request, claim, timeout: float):
+    """Run `claim` until it returns something truthy or `timeout` seconds pass.
+
+    Sleeps on the new-tasks event between attempts rather than returning
+    an empty result right away. Returns None once the worker has hung up,
+    so a task is never claimed for a response nobody will read.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        new_tasks = database.new_tasks_event()
+        if await http_request.is_disconnected():
+            return None
+        claimed = await claim()
+        if claimed:
+            return claimed
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return claimed
+        try:
+            await asyncio.wait_for(new_tasks.wait(), timeout=min(remaining, WORKER_RECHECK_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+
+
+def worker_task_view(task: dict) -> dict:
+    return {"id": task["id"], "task_type": task["task_type"], "payload": task["payload"]}
 
 
-@app.post("/worker/complete/{task_id}")
-async def worker_complete(
-    task_id: str,
-    request: WorkerCompleteRequest,
-    token: str = Depends(verify_token),
+@auth_router.post("/worker/next")
+async def worker_claim_next(http_request: Request, timeout: float = Query(default=0, ge=0, le=60)):
+    """Claim the next pending task for processing.
+
+    With `timeout`, long-polls: holds the request up to that many seconds
+    until a task arrives instead of returning {"task": null} right away.
+    A task whose worker never completes or fails it goes back to pending
+    after TASK_LEASE_SECONDS.
+    """
+    task = await long_poll_claim(http_request, database.claim_next_task, timeout)
+    return {"task": worker_task_view(task) if task else None}
+
+
+@auth_router.post("/worker/next_batch")
+async def worker_claim_next_batch(
+    http_request: Request,
+    max_tasks: int = Query(default=1, ge=1, le=MAX_CLAIM_BATCH_SIZE, alias="max"),
+    timeout: float = Query(default=0, ge=0, le=60),
 ):
-    """Submit result for a task."""
-    result = request.result
+    """Claim the next pending task, plus up to max - 1 more embeddings.
+
+    Embeddings are batched so the worker can embed them in one model call;
+    any other task type comes back alone. Long-polls like /worker/next.
+    """
+    tasks = await long_poll_claim(http_request, lambda: database.claim_next_tasks(max_tasks), timeout)
+    if tasks and await http_request.is_disconnected():
+        # The worker hung up while the batch was being claimed: hand it back
+        # now rather than leaving a whole batch to wait out its lease
+        await database.release_tasks([task["id"] for task in tasks])
+        return {"tasks": []}
+    return {"tasks": [worker_task_view(task) for task in tasks or ()]}
+
+
+def decode_packed_embedding(request: WorkerCompleteRequest) -> bytes:
+    """Validate a packed embedding and return its float32 bytes."""
+    if request.dtype != "float32":
+        raise HTTPException(status_code=400, detail="Unsupported embedding dtype, expected 'float32'")
+    try:
+        packed = base64.b64decode(request.embedding_b64, validate=True)
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="Invalid base64 in 'embedding_b64'")
+    if request.dim is None or len(packed) != 4 * request.dim:
+        raise HTTPException(status_code=400, detail="'embedding_b64' length does not match 'dim'")
+    return packed
+
+
+@auth_router.post("/worker/complete/{task_id}")
+async def worker_complete(task_id: str, request: WorkerCompleteRequest):
+    """Submit result for a task.
+
+    Embeddings may be sent packed (embedding_b64/dim/dtype) instead of as a
+    JSON list in `result`; the packed bytes are stored as they are.
+    """
+    if request.embedding_b64 is not None:
+        result = decode_packed_embedding(request)
+    else:
+        result = request.result
     if result is None:
         raise HTTPException(status_code=400, detail="Missing 'result' field")
-    success = await database.complete_task(task_id, result)
+    try:
+        success = await database.complete_task(task_id, result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not success:
         raise HTTPException(status_code=400, detail="Task not found or not in processing state")
     return {"status": "completed"}
 
 
-@app.post("/worker/fail/{task_id}")
-async def worker_fail(
-    task_id: str,
-    request: WorkerFailRequest,
-    token: str = Depends(verify_token),
-):
+@auth_router.post("/worker/fail/{task_id}")
+async def worker_fail(task_id: str, request: WorkerFailRequest):
     """Report task failure."""
     success = await database.fail_task(task_id, request.error)
     if not success:
@@ -150,8 +320,21 @@ def health():
 
 # OpenAI-compatible endpoints
 
-@app.post("/v1/embeddings", response_model=Union[OpenAIEmbeddingResponse, dict])
-async def openai_embeddings(request: OpenAIEmbeddingRequest, token: str = Depends(verify_token)):
+def task_accepted(task_id: str) -> ORJSONResponse:
+    """202 response for a task still running when the wait times out.
+
+    The Location header lets clients pick up the task ID without parsing
+    the body; the body keeps {"id"} for clients that read it.
+    """
+    return ORJSONResponse({"id": task_id}, status_code=202, headers={"Location": f"/tasks/{task_id}"})
+
+
+@auth_router.post(
+    "/v1/embeddings",
+    response_model=Union[OpenAIEmbeddingResponse, dict],
+    openapi_extra=json_body_openapi(_EMBEDDING_REQUEST_ADAPTER),
+)
+async def openai_embeddings(http_request: Request):
     """OpenAI-compatible embeddings endpoint.
 
     Request:
@@ -161,36 +344,37 @@ async def openai_embeddings(request: OpenAIEmbeddingRequest, token: str = Depend
         {"object": "list", "data": [{"embedding": [...]}], "model": "..."}
 
     On timeout:
-        {"id": "task-id"} - poll GET /tasks/{id} for result
+        202 {"id": "task-id"}, Location: /tasks/{id} - poll it for the result
     """
+    request = await parse_body(_EMBEDDING_REQUEST_ADAPTER, http_request)
     payload = {"text": request.input, "model": request.model}
     task_id = await database.create_task("embedding", payload)
     max_wait = 30  # Fixed wait time for embeddings
-    deadline = time.time() + max_wait
 
-    while time.time() < deadline:
-        task = await database.get_task(task_id)
+    task = await wait_for_task(task_id, max_wait)
+    if task is None:
+        # Timeout - return task ID for polling
+        return task_accepted(task_id)
 
-        if task["status"] == "completed":
-            embedding = json.loads(task["result"])
-            await database.delete_task(task_id)
-            return OpenAIEmbeddingResponse(
-                data=[EmbeddingData(embedding=embedding)],
-                model=request.model
-            )
-        elif task["status"] == "failed":
-            error_msg = task["error"] or "Unknown error"
-            await database.delete_task(task_id)
-            raise HTTPException(status_code=500, detail=error_msg)
+    await database.delete_task(task_id)
+    if task["status"] == "failed":
+        raise HTTPException(status_code=500, detail=task["error"] or "Unknown error")
 
-        await asyncio.sleep(0.2)
+    # Results come from our own worker/DB, so skip re-validating every float.
+    # Returning the response directly also bypasses response_model validation.
+    response = OpenAIEmbeddingResponse.model_construct(
+        data=[EmbeddingData.model_construct(embedding=task["result"])],
+        model=request.model
+    )
+    return ORJSONResponse(response.model_dump())
 
-    # Timeout - return task ID for polling
-    return {"id": task_id}
 
-
-@app.post("/v1/chat/completions", response_model=Union[ChatCompletionResponse, dict])
-async def chat_completions(request: ChatCompletionRequest, token: str = Depends(verify_token)):
+@auth_router.post(
+    "/v1/chat/completions",
+    response_model=Union[ChatCompletionResponse, dict],
+    openapi_extra=json_body_openapi(_CHAT_REQUEST_ADAPTER),
+)
+async def chat_completions(http_request: Request):
     """OpenAI-compatible chat completions endpoint.
 
     Request:
@@ -200,8 +384,9 @@ async def chat_completions(request: ChatCompletionRequest, token: str = Depends(
         {"id": "...", "choices": [{"message": {"role": "assistant", "content": "..."}}], ...}
 
     On timeout:
-        {"id": "task-id"} - poll GET /tasks/{id} for result
+        202 {"id": "task-id"}, Location: /tasks/{id} - poll it for the result
     """
+    request = await parse_body(_CHAT_REQUEST_ADAPTER, http_request)
     if request.stream:
         raise HTTPException(status_code=400, detail="Streaming not supported")
 
@@ -213,29 +398,27 @@ async def chat_completions(request: ChatCompletionRequest, token: str = Depends(
     }
     task_id = await database.create_task("chat", payload)
     max_wait = 180  # Fixed wait time for chat
-    deadline = time.time() + max_wait
-
-    while time.time() < deadline:
-        task = await database.get_task(task_id)
-
-        if task["status"] == "completed":
-            result = json.loads(task["result"])
-            await database.delete_task(task_id)
-            return ChatCompletionResponse(
-                id=task_id,
-                created=int(time.time()),
-                model=request.model,
-                choices=[ChatChoice(
-                    message=ChatMessage(role="assistant", content=result["content"]),
-                    finish_reason=result.get("finish_reason", "stop")
-                )]
-            )
-        elif task["status"] == "failed":
-            error_msg = task["error"] or "Unknown error"
-            await database.delete_task(task_id)
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        await asyncio.sleep(0.2)
-
-    # Timeout - return task ID for polling
-    return {"id": task_id}
+
+    task = await wait_for_task(task_id, max_wait)
+    if task is None:
+        # Timeout - return task ID for polling
+        return task_accepted(task_id)
+
+    await database.delete_task(task_id)
+    if task["status"] == "failed":
+        raise HTTPException(status_code=500, detail=task["error"] or "Unknown error")
+
+    result = task["result"]
+    response = ChatCompletionResponse.model_construct(
+        id=task_id,
+        created=int(time.time()),
+        model=request.model,
+        choices=[ChatChoice.model_construct(
+            message=ChatMessage.model_construct(role="assistant", content=result["content"]),
+            finish_reason=result.get("finish_reason", "stop")
+        )]
+    )
+    return ORJSONResponse(response.model_dump())
+
+
+app.include_router(auth_router)
@@ -58,7 +58,11 @@ class ChatCompletionResponse(BaseModel):
 
 
 class WorkerCompleteRequest(BaseModel):
-    result: Any  # Generic result field for any task type (can be dict, list, etc.)
+    result: Any = None  # Generic result field for any task type (can be dict, list, etc.)
+    # Alternative for embeddings: base64 of the vector's little-endian float32 bytes
+    embedding_b64: Optional[str] = None
+    dim: Optional[int] = None
+    dtype: Optional[str] = None
 
 
 class WorkerFailRequest(BaseModel):
@@ -9,12 +9,13 @@ Usage:
 
 import asyncio
 import aiohttp
+import orjson
 import time
 import argparse
 import random
 
 
-# Test questions dataset - randomly selected for each request
+# Test questions dataset - one is picked at random for each request
 TEST_QUESTIONS = [
     "What is the meaning of life?",
     "How does machine learning work?",
@@ -74,13 +75,8 @@ TEST_QUESTIONS = [
 ]
 
 
-async def submit_request(session, url, headers, task_num, task_type="embedding"):
-    """Submit a single request and return response."""
-    start = time.time()
-    
-    # Select a random question from the test set
-    question = random.choice(TEST_QUESTIONS)
-    
+def build_payload(task_type, question):
+    """Encode the request body for one question."""
     if task_type == "embedding":
         payload = {"input": question, "model": "nomic-embed-text"}
     else:  # chat
@@ -90,151 +86,278 @@ async def submit_request(session, url, headers, task_num, task_type="embedding")
                 {"role": "user", "content": question}
             ]
         }
-    
-    try:
-        # Use a longer timeout for chat completions to match the server's 180s wait time
-        request_timeout = 185 if task_type == "chat" else 120
-        async with session.post(url, 
-            json=payload,
-            headers=headers,
-            timeout=request_timeout) as resp:
-            elapsed = time.time() - start
-            data = await resp.json()
-            if resp.status == 200:
-                if task_type == "embedding":
-                    # Check if we got a result or just task ID
-                    if "data" in data:  # Full embedding result
-                        return {
-                            "num": task_num,
-                            "status": "completed",
-                            "result": f"{len(data['data'][0]['embedding'])} dims",
-                            "elapsed": elapsed,
-                        }
-                    elif "id" in data:  # Task ID (not yet complete)
-                        return {
-                            "num": task_num,
-                            "status": "pending",
-                            "task_id": data.get("id"),
-                            "elapsed": elapsed,
-                        }
-                else:  # chat
-                    # Check if we got a result or task ID
-                    if "choices" in data:  # Full chat result
-                        content = data["choices"][0]["message"]["content"]
-                        return {
-                            "num": task_num,
-                            "status": "completed",
-                            "result": f"{len(content)} chars",
-                            "content": content,  # Store full content
-                            "elapsed": elapsed,
-                        }
-                    elif "id" in data:  # Task ID (not yet complete)
-                        return {
-                            "num": task_num,
-                            "status": "pending",
-                            "task_id": data.get("id"),
-                            "elapsed": elapsed,
-                        }
+    return orjson.dumps(payload)
+
+
+def parse_response(task_num, task_type, elapsed, status, location, body):
+    """Turn a response into a result dict; `body` is only read for a 200."""
+    if status == 202:
+        # Still processing: the task ID is in the Location header
+        return {
+            "num": task_num,
+            "status": "pending",
+            "task_id": location.rsplit("/", 1)[-1],
+            "elapsed": elapsed,
+        }
+    if status == 200:
+        data = orjson.loads(body)
+        if task_type == "embedding":
+            # Check if we got a result or just task ID
+            if "data" in data:  # Full embedding result
                 return {
                     "num": task_num,
-                    "status": "unknown",
-                    "data": str(data)[:50],
+                    "status": "completed",
+                    "result": f"{len(data['data'][0]['embedding'])} dims",
                     "elapsed": elapsed,
                 }
-            else:
+            elif "id" in data:  # Task ID (not yet complete)
                 return {
                     "num": task_num,
-                    "status": f"error_{resp.status}",
+                    "status": "pending",
+                    "task_id": data.get("id"),
+                    "elapsed": elapsed,
+                }
+        else:  # chat
+            # Check if we got a result or task ID
+            if "choices" in data:  # Full chat result
+                content = data["choices"][0]["message"]["content"]
+                return {
+                    "num": task_num,
+                    "status": "completed",
+                    "result": f"{len(content)} chars",
+                    "content": content,  # Store full content
+                    "elapsed": elapsed,
+                }
+            elif "id" in data:  # Task ID (not yet complete)
+                return {
+                    "num": task_num,
+                    "status": "pending",
+                    "task_id": data.get("id"),
                     "elapsed": elapsed,
                 }
-    except Exception as e:
-        elapsed = time.time() - start
         return {
             "num": task_num,
-            "status": "exception",
-            "error": str(e),
+            "status": "unknown",
+            "data": str(data)[:50],
             "elapsed": elapsed,
         }
+    return {
+        "num": task_num,
+        "status": f"error_{status}",
+        "elapsed": elapsed,
+    }
 
 
-async def run_test(url, token, num_requests, concurrency, task_type="embedding"):
-    """Run the stress test."""
+def exception_result(task_num, error, start):
+    """Result dict for a request that raised instead of getting a response."""
+    return {
+        "num": task_num,
+        "status": "exception",
+        "error": str(error),
+        "elapsed": time.time() - start,
+    }
+
+
+async def submit_request(session, url, headers, timeout, task_num, payload_bytes, task_type="embedding"):
+    """Submit a single request and return response."""
+    start = time.time()
+    
+    try:
+        async with session.post(url,
+            data=payload_bytes,
+            headers=headers,
+            timeout=timeout) as resp:
+            elapsed = time.time() - start
+            # A 202 carries its task ID in a header, so its body is never read
+            body = await resp.read() if resp.status == 200 else None
+            return parse_response(task_num, task_type, elapsed, resp.status, resp.headers.get("Location"), body)
+    except Exception as e:
+        return exception_result(task_num, e, start)
+
+
+def submit_request_sync(url, headers, timeout, payload_bytes, task_type="embedding"):
+    """Blocking version of submit_request for a single-request run."""
+    # Only single-request runs need requests, so it isn't a hard dependency
+    import requests
+
+    start = time.time()
+    
+    try:
+        resp = requests.post(url, data=payload_bytes, headers=headers, timeout=timeout)
+        elapsed = time.time() - start
+        return parse_response(0, task_type, elapsed, resp.status_code, resp.headers.get("Location"), resp.content)
+    except Exception as e:
+        return exception_result(0, e, start)
+
+
+def print_result(result, num_requests, pending_count, task_type):
+    """Print the progress line for one finished request."""
+    i = result["num"]
+    status_str = result['status'].ljust(12)
+    result_str = result.get('result', result.get('task_id', ''))[:30]
+    if task_type == "chat" and result.get('content'):
+        print(f"[{i+1:2d}/{num_requests}] {status_str} {result.get('elapsed', 0):.3f}s → \"{result['content']}\" , load: {pending_count}")
+    else:
+        print(f"[{i+1:2d}/{num_requests}] {status_str} {result.get('elapsed', 0):.3f}s {result_str}, load: {pending_count}")
+
+
+class Stats:
+    """Running totals for a test run, updated as each result arrives.
+
+    Results are dropped once counted, so memory stays flat however many
+    requests are sent.
+    """
+
+    __slots__ = ("completed", "pending", "errors", "count", "min_time", "max_time", "total_time", "task_ids", "task_id_count")
+
+    # How many pending task IDs to keep for the summary
+    SAMPLE_TASK_IDS = 3
+
+    def __init__(self):
+        self.completed = self.pending = self.errors = self.count = 0
+        self.min_time, self.max_time, self.total_time = float("inf"), 0.0, 0.0
+        self.task_ids = []
+        self.task_id_count = 0
+
+    def add(self, result):
+        status = result["status"]
+        if status == "completed":
+            self.completed += 1
+        elif status == "pending":
+            self.pending += 1
+        elif status != "ok":
+            self.errors += 1
+        task_id = result.get("task_id")
+        if task_id:
+            self.task_id_count += 1
+            if len(self.task_ids) < self.SAMPLE_TASK_IDS:
+                self.task_ids.append(task_id)
+        elapsed = result["elapsed"]
+        self.count += 1
+        if elapsed < self.min_time:
+            self.min_time = elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.total_time += elapsed
+
+
+def prepare_test(url, token, num_requests, concurrency, task_type):
+    """Print the test banner and return the target URL, headers and timeout."""
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    connector = aiohttp.TCPConnector(limit=concurrency)
     
     if task_type == "embedding":
         endpoint = "/v1/embeddings"
-        wait_desc = "(120s timeout)"
+        timeout_seconds = 120
     else:
         endpoint = "/v1/chat/completions"
-        wait_desc = "(185s timeout)"
+        # Longer timeout for chat completions to match the server's 180s wait time
+        timeout_seconds = 185
+    # Built once here rather than per request
+    full_url = f"{url}{endpoint}"
     
     print(f"\n🔥 SIMPLE STRESS TEST - {task_type.upper()}")
     print(f"   Requests: {num_requests}")
     print(f"   Concurrency: {concurrency}")
-    print(f"   Endpoint: {url}{endpoint} {wait_desc}\n")
+    print(f"   Endpoint: {full_url} ({timeout_seconds}s timeout)\n")
+    return full_url, headers, timeout_seconds
+
+
+def run_single(url, token, concurrency, task_type="embedding"):
+    """Run a one-request test as a single blocking call.
+
+    There is nothing to run concurrently, so no event loop, connector,
+    semaphore or task machinery is set up.
+    """
+    full_url, headers, timeout_seconds = prepare_test(url, token, 1, concurrency, task_type)
+    stats = Stats()
+    start_total = time.time()
+    result = submit_request_sync(full_url, headers, timeout_seconds, build_payload(task_type, random.choice(TEST_QUESTIONS)), task_type)
+    total_time = time.time() - start_total
+    stats.add(result)
+    print_result(result, 1, 1 - stats.completed, task_type)
+    print_summary(stats, 1, total_time)
+
+
+async def run_test(url, token, num_requests, concurrency, task_type="embedding"):
+    """Run the stress test."""
+    full_url, headers, timeout_seconds = prepare_test(url, token, num_requests, concurrency, task_type)
+    timeout = aiohttp.ClientTimeout(total=timeout_seconds)
     
-    results = []
+    # No connector-level caps: the semaphore below is the only admission
+    # control, so --concurrency is never silently clamped by the connector
+    # (aiohttp defaults to 100 sockets) and requests aren't gated twice.
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=0,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+    )
+    
+    # Encoded up front so the request loop only sends bytes
+    payloads = [build_payload(task_type, random.choice(TEST_QUESTIONS)) for _ in range(num_requests)]
+    
+    stats = Stats()
     semaphore = asyncio.Semaphore(concurrency)
-    completed_count = 0
-    pending_count = num_requests
-    lock = asyncio.Lock()
     
     async def bounded_request(i, session):
-        nonlocal completed_count, pending_count
-        async with semaphore:
-            result = await submit_request(session, f"{url}{endpoint}", headers, i, task_type)
-            results.append(result)
-            
-            async with lock:
-                if result['status'] == 'completed':
-                    completed_count += 1
-                    pending_count = num_requests - completed_count
-                    
-            status_str = result['status'].ljust(12)
-            result_str = result.get('result', result.get('task_id', ''))[:30]
-            if task_type == "chat" and result.get('content'):
-                print(f"[{i+1:2d}/{num_requests}] {status_str} {result.get('elapsed', 0):.3f}s → \"{result['content']}\" , load: {pending_count}")
-            else:
-                print(f"[{i+1:2d}/{num_requests}] {status_str} {result.get('elapsed', 0):.3f}s {result_str}, load: {pending_count}")
+        # The slot was acquired by the loop below before this task was created
+        try:
+            result = await submit_request(session, full_url, headers, timeout, i, payloads[i], task_type)
+        finally:
+            semaphore.release()
+        
+        # No lock needed: there is no await between the read and the write,
+        # so the update can't interleave with another request's on the event loop
+        stats.add(result)
+        print_result(result, num_requests, num_requests - stats.completed, task_type)
     
     start_total = time.time()
-    async with aiohttp.ClientSession(connector=connector) as session:
-        await asyncio.gather(*[bounded_request(i, session) for i in range(num_requests)])
+    async with aiohttp.ClientSession(connector=connector, connector_owner=True) as session:
+        # Acquire before creating each task, so no more than `concurrency`
+        # request tasks exist at once instead of one per request up front
+        async with asyncio.TaskGroup() as tg:
+            for i in range(num_requests):
+                await semaphore.acquire()
+                tg.create_task(bounded_request(i, session))
     total_time = time.time() - start_total
-    
-    # Print summary
+    print_summary(stats, num_requests, total_time)
+
+
+def print_summary(stats, num_requests, total_time):
+    """Print the end-of-run summary."""
     print(f"\n{'='*60}")
     print(f"RESULTS ({total_time:.1f}s total)")
     print(f"{'='*60}")
     
-    completed_count = sum(1 for r in results if r["status"] == "completed")
-    pending_count = sum(1 for r in results if r["status"] == "pending")
-    error_count = sum(1 for r in results if r["status"] not in ("completed", "pending", "ok"))
-    
-    print(f"✅ Completed: {completed_count}/{num_requests}")
-    if pending_count > 0:
-        print(f"⏳ Pending: {pending_count}/{num_requests}")
-    if error_count > 0:
-        print(f"❌ Failed: {error_count}/{num_requests}")
+    print(f"✅ Completed: {stats.completed}/{num_requests}")
+    if stats.pending > 0:
+        print(f"⏳ Pending: {stats.pending}/{num_requests}")
+    if stats.errors > 0:
+        print(f"❌ Failed: {stats.errors}/{num_requests}")
     
     print(f"📊 Throughput: {num_requests / total_time:.1f} req/s")
     
-    if results:
-        times = [r["elapsed"] for r in results]
-        print(f"⏱️  Response times: min={min(times):.3f}s, max={max(times):.3f}s, avg={sum(times)/len(times):.3f}s")
+    if stats.count:
+        print(f"⏱️  Response times: min={stats.min_time:.3f}s, max={stats.max_time:.3f}s, avg={stats.total_time/stats.count:.3f}s")
     
     # Show task IDs for pending tasks
-    task_ids = [r.get("task_id") for r in results if r.get("task_id")]
-    if task_ids:
-        print(f"\n💾 Pending tasks ({len(task_ids)}):")
-        for tid in task_ids[:3]:
+    if stats.task_ids:
+        print(f"\n💾 Pending tasks ({stats.task_id_count}):")
+        for tid in stats.task_ids:
             print(f"   - {tid}")
-        if len(task_ids) > 3:
-            print(f"   ... and {len(task_ids) - 3} more")
+        if stats.task_id_count > len(stats.task_ids):
+            print(f"   ... and {stats.task_id_count - len(stats.task_ids)} more")
+
+
+def run(url, token, num_requests, concurrency, task_type):
+    if num_requests == 1:
+        run_single(url, token, concurrency, task_type)
+    else:
+        asyncio.run(run_test(url, token, num_requests, concurrency, task_type))
 
 
-async def main():
+def main():
     parser = argparse.ArgumentParser(description="Simple stress test for LLMeQueue")
     parser.add_argument("--url", default="http://localhost:8000")
     parser.add_argument("--token", default="your-secret-token")
@@ -247,12 +370,12 @@ async def main():
     try:
         if args.task_type == "both":
             # Run embedding tests first
-            await run_test(args.url, args.token, args.requests, args.concurrency, "embedding")
+            run(args.url, args.token, args.requests, args.concurrency, "embedding")
             print("\n")
             # Then run chat tests
-            await run_test(args.url, args.token, args.requests, args.concurrency, "chat")
+            run(args.url, args.token, args.requests, args.concurrency, "chat")
         else:
-            await run_test(args.url, args.token, args.requests, args.concurrency, args.task_type)
+            run(args.url, args.token, args.requests, args.concurrency, args.task_type)
     except KeyboardInterrupt:
         print("\n⏹️  Test cancelled")
     except Exception as e:
@@ -262,4 +385,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -1,13 +1,24 @@
-import requests
-from config import OLLAMA_URL, CHAT_MODEL
+import aiohttp
+import orjson
+from config import OLLAMA_URL, CHAT_MODEL, OLLAMA_KEEP_ALIVE
 
+# 5 minutes for longer generations, but give up on a stream that stalls
+_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_read=60)
 
-def get_chat_completion(messages: list[dict], model: str = None, temperature: float = 0.7, max_tokens: int = None) -> dict:
-    """Get chat completion from Ollama API."""
+
+async def get_chat_completion(session: aiohttp.ClientSession, messages: list[dict], model: str = None, temperature: float = 0.7, max_tokens: int = None) -> dict:
+    """Get chat completion from Ollama API.
+
+    The response is streamed and accumulated chunk by chunk, so the result
+    is ready as soon as the final chunk arrives. If Ollama keeps generating
+    past max_tokens (one chunk per token), the stream is cut off there; a
+    stream that ends without its final chunk raises ValueError.
+    """
     payload = {
         "model": model or CHAT_MODEL,
         "messages": messages,
-        "stream": False,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": temperature,
         }
@@ -15,20 +26,38 @@ def get_chat_completion(messages: list[dict], model: str = None, temperature: fl
     if max_tokens:
         payload["options"]["num_predict"] = max_tokens
 
-    response = requests.post(
+    parts = []
+    finish_reason = None
+    async with session.post(
         f"{OLLAMA_URL}/api/chat",
         json=payload,
-        timeout=300,  # 5 minutes for longer generations
-    )
-    response.raise_for_status()
-    data = response.json()
-    
-    try:
-        content = data["message"]["content"]
-    except (KeyError, TypeError) as exc:
-        raise ValueError(f"Malformed Ollama API response: expected 'message.content' field, got: {data!r}") from exc
-    
+        timeout=_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            if not line.strip():
+                continue
+            chunk = orjson.loads(line)
+            if "error" in chunk:
+                raise ValueError(f"Ollama API error: {chunk['error']}")
+            try:
+                parts.append(chunk["message"]["content"])
+            except (KeyError, TypeError) as exc:
+                raise ValueError(f"Malformed Ollama API response: expected 'message.content' field, got: {chunk!r}") from exc
+            if chunk.get("done"):
+                # Let the loop end on its own so the connection is reused
+                finish_reason = "length" if chunk.get("done_reason") == "length" else "stop"
+            elif max_tokens and len(parts) > max_tokens:
+                # Clearly past the cap (num_predict normally ends the stream
+                # right at it): cut here, giving up the connection
+                del parts[max_tokens:]
+                finish_reason = "length"
+                break
+
+    if finish_reason is None:
+        raise ValueError("Ollama stream ended before the final chunk")
+
     return {
-        "content": content,
-        "finish_reason": "length" if not data.get("done") else "stop"
+        "content": "".join(parts),
+        "finish_reason": finish_reason
     }
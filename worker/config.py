@@ -5,5 +5,9 @@ AUTH_TOKEN = os.getenv("AUTH_TOKEN", "default-secret-token")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "llama3.2:3b")
-POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "1"))  # poll interval in seconds (default 1s, float allows more granular control)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # how long Ollama keeps a model loaded after a call
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "1"))  # initial retry delay in seconds after errors (floored at 0.1s)
 MAX_POLL_INTERVAL = float(os.getenv("MAX_POLL_INTERVAL", "10"))  # max backoff seconds
+LONG_POLL_TIMEOUT = float(os.getenv("LONG_POLL_TIMEOUT", "25"))  # seconds the server may hold /worker/next waiting for a task
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))  # max tasks in flight per worker process
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))  # max embedding tasks claimed and sent to Ollama at once
@@ -1,17 +1,30 @@
-import requests
-from config import OLLAMA_URL, EMBEDDING_MODEL
+import aiohttp
+import orjson
+from array import array
+from config import OLLAMA_URL, EMBEDDING_MODEL, OLLAMA_KEEP_ALIVE
 
+_TIMEOUT = aiohttp.ClientTimeout(total=60)
 
-def get_embedding(text: str, model: str = None) -> list[float]:
-    """Get embedding from Ollama API."""
-    response = requests.post(
-        f"{OLLAMA_URL}/api/embeddings",
+
+async def get_embeddings(session: aiohttp.ClientSession, texts: list[str], model: str = None) -> list[array]:
+    """Get embeddings for several texts in one Ollama /api/embed call.
+
+    Each embedding is returned as a compact float32 array rather than a
+    list of Python floats.
+    """
+    async with session.post(
+        f"{OLLAMA_URL}/api/embed",
         json={
             "model": model or EMBEDDING_MODEL,
-            "prompt": text,
+            "input": texts,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
         },
-        timeout=60,
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["embedding"]
+        timeout=_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        data = orjson.loads(await response.read())
+
+    embeddings = data.get("embeddings")
+    if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+        raise ValueError(f"Malformed Ollama API response: expected {len(texts)} embeddings, got: {data!r}")
+    return [array("f", embedding) for embedding in embeddings]
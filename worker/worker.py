@@ -1,63 +1,145 @@
+import asyncio
+import aiohttp
+import base64
+import orjson
+import random
+import sys
 import time
-import requests
+from array import array
 from typing import Any
-from config import SERVER_URL, AUTH_TOKEN, POLL_INTERVAL, MAX_POLL_INTERVAL
-from embedder import get_embedding
+from config import SERVER_URL, AUTH_TOKEN, POLL_INTERVAL, MAX_POLL_INTERVAL, LONG_POLL_TIMEOUT, WORKER_CONCURRENCY, EMBEDDING_BATCH_SIZE, EMBEDDING_MODEL, CHAT_MODEL
+from embedder import get_embeddings
 from chat import get_chat_completion
 
+HEADERS = {"Authorization": f"Bearer {AUTH_TOKEN}"}
 
-def get_headers():
-    return {"Authorization": f"Bearer {AUTH_TOKEN}"}
+_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# The server holds /worker/next_batch for up to LONG_POLL_TIMEOUT, so allow for that
+_CLAIM_TIMEOUT = aiohttp.ClientTimeout(total=LONG_POLL_TIMEOUT + 5)
+# Never retry failed calls faster than this
+_MIN_RETRY_INTERVAL = 0.1
 
 
-def claim_next_task():
-    """Request the next task from the server."""
-    response = requests.post(
-        f"{SERVER_URL}/worker/next",
-        headers=get_headers(),
-        timeout=30,
+def retry_delay(backoff: float) -> float:
+    """Jitter a backoff delay so workers that fail together don't retry together."""
+    return max(backoff * random.uniform(0.5, 1.5), _MIN_RETRY_INTERVAL)
+
+
+def json_dumps(obj: Any) -> str:
+    """orjson-backed json_serialize for aiohttp sessions."""
+    return orjson.dumps(obj).decode()
+
+
+def create_server_session() -> aiohttp.ClientSession:
+    """Session for calls to SERVER_URL, separate from the Ollama one.
+
+    Auth headers are set once on the session, and the pool holds enough
+    kept-alive connections for every slot to complete a full embedding batch
+    at once, plus one for the long-polled claim.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=WORKER_CONCURRENCY * EMBEDDING_BATCH_SIZE + 1,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
     )
-    response.raise_for_status()
-    data = response.json()
-    return data.get("task")
+    return aiohttp.ClientSession(connector=connector, headers=HEADERS, json_serialize=json_dumps)
+
 
+async def claim_next_tasks(session: aiohttp.ClientSession) -> list[dict]:
+    """Request the next task from the server, long-polling until one is available.
 
-def complete_task(task_id: str, result: Any):
+    If it is an embedding, the server adds up to EMBEDDING_BATCH_SIZE - 1
+    more pending embeddings to the batch.
+    """
+    async with session.post(
+        f"{SERVER_URL}/worker/next_batch",
+        params={"max": EMBEDDING_BATCH_SIZE, "timeout": LONG_POLL_TIMEOUT},
+        timeout=_CLAIM_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        data = orjson.loads(await response.read())
+    return data.get("tasks") or []
+
+
+async def complete_task(session: aiohttp.ClientSession, task_id: str, result: Any):
     """Submit completed result to the server."""
-    response = requests.post(
+    await submit_completion(session, task_id, {"result": result})
+
+
+async def complete_embedding(session: aiohttp.ClientSession, task_id: str, embedding: array):
+    """Submit an embedding as base64 of its little-endian float32 bytes."""
+    if sys.byteorder == "big":
+        embedding = array("f", embedding)
+        embedding.byteswap()
+    await submit_completion(session, task_id, {
+        "embedding_b64": base64.b64encode(embedding.tobytes()).decode(),
+        "dim": len(embedding),
+        "dtype": "float32",
+    })
+
+
+async def submit_completion(session: aiohttp.ClientSession, task_id: str, body: dict):
+    async with session.post(
         f"{SERVER_URL}/worker/complete/{task_id}",
-        headers=get_headers(),
-        json={"result": result},
-        timeout=30,
-    )
-    response.raise_for_status()
+        json=body,
+        timeout=_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
 
 
-def fail_task(task_id: str, error: str):
+async def fail_task(session: aiohttp.ClientSession, task_id: str, error: str):
     """Report task failure to the server."""
-    response = requests.post(
+    async with session.post(
         f"{SERVER_URL}/worker/fail/{task_id}",
-        headers=get_headers(),
         json={"error": error},
-        timeout=30,
-    )
-    response.raise_for_status()
+        timeout=_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
 
 
-def process_embedding_task(task_id: str, payload: dict):
-    """Process an embedding task."""
-    text = payload.get("text")
-    if not isinstance(text, str):
-        raise ValueError("Embedding task payload must include a 'text' field of type string.")
-    model = payload.get("model")
-    print(f"[embedding] {task_id}: {text[:50]}...")
+async def process_embedding_tasks(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, tasks: list[dict]):
+    """Process a batch of embedding tasks, one Ollama call per model."""
+    by_model = {}
+    for task in tasks:
+        text = task["payload"].get("text")
+        if not isinstance(text, str):
+            await report_failure(server, task, "Embedding task payload must include a 'text' field of type string.")
+            continue
+        by_model.setdefault(task["payload"].get("model"), []).append((task, text))
+
+    await asyncio.gather(*(
+        process_embedding_group(ollama, server, model, group)
+        for model, group in by_model.items()
+    ))
+
+
+async def process_embedding_group(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, model: str, group: list[tuple[dict, str]]):
+    """Embed texts that share a model in one call, then complete each task."""
+    for task, text in group:
+        print(f"[embedding] {task['id']}: {text[:50]}...")
+
+    try:
+        embeddings = await get_embeddings(ollama, [text for _, text in group], model)
+    except Exception as e:
+        await asyncio.gather(*(report_failure(server, task, str(e)) for task, _ in group))
+        return
+
+    await asyncio.gather(*(
+        complete_embedding_task(server, task, embedding)
+        for (task, _), embedding in zip(group, embeddings)
+    ))
 
-    embedding = get_embedding(text, model)
-    complete_task(task_id, embedding)
-    print(f"[embedding] {task_id} completed (dim: {len(embedding)})")
+
+async def complete_embedding_task(server: aiohttp.ClientSession, task: dict, embedding: array):
+    try:
+        await complete_embedding(server, task["id"], embedding)
+    except Exception as e:
+        await report_failure(server, task, str(e))
+        return
+    print(f"[embedding] {task['id']} completed (dim: {len(embedding)})")
 
 
-def process_chat_task(task_id: str, payload: dict):
+async def process_chat_task(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, task_id: str, payload: dict):
     """Process a chat completion task."""
     messages = payload.get("messages")
     if messages is None:
@@ -67,59 +149,118 @@ def process_chat_task(task_id: str, payload: dict):
     max_tokens = payload.get("max_tokens")
     print(f"[chat] {task_id}: {len(messages)} messages, model={model}")
 
-    result = get_chat_completion(messages, model, temperature, max_tokens)
-    complete_task(task_id, result)
+    result = await get_chat_completion(ollama, messages, model, temperature, max_tokens)
+    await complete_task(server, task_id, result)
     print(f"[chat] {task_id} completed ({len(result['content'])} chars)")
 
 
-def process_task(task: dict):
-    """Process a single task."""
-    task_id = task["id"]
+async def report_failure(server: aiohttp.ClientSession, task: dict, error_msg: str):
+    """Log a task failure and report it to the server."""
+    print(f"[{task['task_type']}] {task['id']} failed: {error_msg}")
+    try:
+        await fail_task(server, task["id"], error_msg)
+    except Exception as fail_error:
+        print(f"Could not report failure: {fail_error}")
+
+
+async def process_task(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, task: dict):
+    """Process a single non-embedding task."""
     task_type = task["task_type"]
-    payload = task["payload"]
 
     try:
-        if task_type == "embedding":
-            process_embedding_task(task_id, payload)
-        elif task_type == "chat":
-            process_chat_task(task_id, payload)
+        if task_type == "chat":
+            await process_chat_task(ollama, server, task["id"], task["payload"])
         else:
             raise ValueError(f"Unknown task type: {task_type}")
     except Exception as e:
-        error_msg = str(e)
-        print(f"[{task_type}] {task_id} failed: {error_msg}")
-        try:
-            fail_task(task_id, error_msg)
-        except Exception as fail_error:
-            print(f"Could not report failure: {fail_error}")
+        await report_failure(server, task, str(e))
+
+
+async def process_tasks(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, tasks: list[dict]):
+    """Process a claimed batch: embeddings together, anything else one by one."""
+    embeddings = [task for task in tasks if task["task_type"] == "embedding"]
+    others = [task for task in tasks if task["task_type"] != "embedding"]
+
+    jobs = [process_task(ollama, server, task) for task in others]
+    if embeddings:
+        jobs.append(process_embedding_tasks(ollama, server, embeddings))
+    await asyncio.gather(*jobs)
+
+
+async def _run_and_release(ollama: aiohttp.ClientSession, server: aiohttp.ClientSession, tasks: list[dict], limiter: asyncio.Semaphore):
+    try:
+        await process_tasks(ollama, server, tasks)
+    finally:
+        limiter.release()
+
+
+async def warm_up(ollama: aiohttp.ClientSession):
+    """Load the default models into Ollama so the first real task doesn't pay for it."""
+    results = await asyncio.gather(
+        get_embeddings(ollama, ["warmup"]),
+        get_chat_completion(ollama, [{"role": "user", "content": "hi"}], max_tokens=1),
+        return_exceptions=True,
+    )
+    for model, result in zip((EMBEDDING_MODEL, CHAT_MODEL), results):
+        if isinstance(result, Exception):
+            print(f"Warmup of {model} failed: {result}")
+        else:
+            print(f"Warmed up {model}")
+
 
+async def main():
+    """Main worker loop: keeps up to WORKER_CONCURRENCY claims in flight.
 
-def main():
-    """Main worker loop with exponential backoff."""
+    A claim is a single task or a batch of up to EMBEDDING_BATCH_SIZE
+    embeddings. The server long-polls the claim, so an empty response means
+    no work arrived during LONG_POLL_TIMEOUT and the claim is reissued
+    immediately.
+    Errors are retried with jittered exponential backoff.
+    """
     print(f"Worker starting. Server: {SERVER_URL}")
-    print(f"Poll interval: {POLL_INTERVAL}s, max backoff: {MAX_POLL_INTERVAL}s")
-
-    backoff = POLL_INTERVAL
-    
-    while True:
-        try:
-            task = claim_next_task()
-            if task:
-                process_task(task)
-                # Reset backoff on successful task claim
-                backoff = POLL_INTERVAL
-            else:
-                # No task - exponential backoff
-                time.sleep(backoff)
+    print(f"Concurrency: {WORKER_CONCURRENCY}, embedding batch: {EMBEDDING_BATCH_SIZE}, long poll: {LONG_POLL_TIMEOUT}s, retry backoff: {POLL_INTERVAL}s-{MAX_POLL_INTERVAL}s")
+
+    limiter = asyncio.Semaphore(WORKER_CONCURRENCY)
+    # Strong references so in-flight tasks aren't garbage collected
+    in_flight = set()
+    initial_backoff = max(POLL_INTERVAL, _MIN_RETRY_INTERVAL)
+    backoff = initial_backoff
+
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=0, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector, json_serialize=json_dumps) as ollama, create_server_session() as server:
+        await warm_up(ollama)
+        while True:
+            # Only claim once there is a free slot to run the claimed tasks
+            await limiter.acquire()
+            claim_started = time.monotonic()
+            try:
+                tasks = await claim_next_tasks(server)
+            except Exception as e:
+                limiter.release()
+                print(f"Error in worker loop: {e}")
+                await asyncio.sleep(retry_delay(backoff))
                 backoff = min(backoff * 1.5, MAX_POLL_INTERVAL)
-        except KeyboardInterrupt:
-            print("\nWorker stopped.")
-            break
-        except Exception as e:
-            print(f"Error in worker loop: {e}")
-            time.sleep(backoff)
-            backoff = min(backoff * 1.5, MAX_POLL_INTERVAL)
+                continue
+
+            if not tasks:
+                limiter.release()
+                # An empty answer well before the long-poll timeout means the
+                # server doesn't hold the request (older server) - back off
+                # instead of spinning
+                if time.monotonic() - claim_started < LONG_POLL_TIMEOUT / 2:
+                    await asyncio.sleep(retry_delay(backoff))
+                    backoff = min(backoff * 1.5, MAX_POLL_INTERVAL)
+                continue
+
+            # Reset backoff on successful task claim
+            backoff = initial_backoff
+            running = asyncio.create_task(_run_and_release(ollama, server, tasks, limiter))
+            in_flight.add(running)
+            running.add_done_callback(in_flight.discard)
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nWorker stopped.")